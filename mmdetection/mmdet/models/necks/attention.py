@@ -8,10 +8,10 @@ from mmcv.runner import auto_fp16
 from .attention_module.fusion_attention import FusionAttention
 from .attention_module.context_fusion_block import ContextBlock
 from .attention_module.context_weight_block import ContextWeightBlcok
-from .attention_module.attention_augmented import AugmentedAttention
+from .attention_module.attention_augmented import (AugmentedAttention,
+                                                    AugmentedConv)
 from .attention_module.self_attention import SelfAttention
 from ..builder import NECKS
-import matplotlib.pyplot as plt
 
 
 @NECKS.register_module()
@@ -52,6 +52,21 @@ class Attention(nn.Module):
             Default: None.
         upsample_cfg (dict): Config dict for interpolate layer.
             Default: `dict(mode='nearest')`
+        script_attention (bool): Whether to compile the fusion attention
+            modules with TorchScript once their weights are initialized.
+            Only supported for `attention_type='augmented'`. A neck with
+            scripted attention can be deep-copied but not pickled.
+            Default: False.
+        bf16_attention (bool): Whether to run the attention of the augmented
+            attention modules under bfloat16 autocast. Only supported for
+            `attention_type='augmented'` and not together with
+            `script_attention`. Default: False.
+        channels_last (bool): Whether to keep the weights and the features in
+            `torch.channels_last` memory format, which lets cuDNN use its
+            NHWC kernels. Default: False.
+        collapse_downsample (bool): Whether to downsample by more than one
+            level with an average pooling followed by a single stride-2
+            conv instead of a chain of stride-2 convs. Default: False.
 
     Example:
         >>> import torch
@@ -99,6 +114,10 @@ class Attention(nn.Module):
                  down_sharing=False,
                  attention_sharing=False,
                  out_sharing=False,
+                 script_attention=False,
+                 bf16_attention=False,
+                 channels_last=False,
+                 collapse_downsample=False,
                  viz=False):
         super(Attention, self).__init__()
         assert isinstance(in_channels, list)
@@ -113,11 +132,30 @@ class Attention(nn.Module):
         self.no_norm_on_lateral = no_norm_on_lateral
         self.fp16_enabled = False
         self.upsample_cfg = upsample_cfg.copy()
+        # any other key would be silently dropped by the bound options below
+        assert set(self.upsample_cfg) <= {
+            'mode', 'align_corners', 'scale_factor'
+        }, f'unsupported upsample_cfg keys: {sorted(self.upsample_cfg)}'
+        # bound once so the O(L^2) interpolations in `_fuse_level` and the
+        # top-down paths do not unpack the config dict on every call
+        self._upsample_mode = self.upsample_cfg.get('mode', 'nearest')
+        self._upsample_align_corners = self.upsample_cfg.get(
+            'align_corners', None)
+        self._upsample_scale = self.upsample_cfg.get('scale_factor', None)
+        self._use_scale_factor = self._upsample_scale is not None
         self.repeated_layer = repeated_layer
         self.residual = residual
         self.down_sharing = down_sharing
         self.attention_sharing = attention_sharing
         self.out_sharing = out_sharing
+        self.script_attention = script_attention
+        self.channels_last = channels_last
+        self.collapse_downsample = collapse_downsample
+        assert not script_attention or attention_type == 'augmented'
+        assert not bf16_attention or attention_type == 'augmented'
+        # TorchScript ignores the autocast of the bf16 attention
+        assert not (script_attention and bf16_attention), \
+            'script_attention and bf16_attention are mutually exclusive'
         self.viz = viz
         if end_level == -1:
             self.backbone_end_level = self.num_ins
@@ -181,7 +219,8 @@ class Attention(nn.Module):
                             AugmentedAttention(levels=self.num_ins - start_level,
                                                in_channels=out_channels * (self.num_ins - start_level),
                                                out_channels=out_channels,
-                                               map_repeated=map_repeated)
+                                               map_repeated=map_repeated,
+                                               bf16=bf16_attention)
                         )
                     elif attention_type == 'self':
                         self.fusion_attentions[-1].append(
@@ -204,7 +243,12 @@ class Attention(nn.Module):
                         inplace=False))
                 for j in range(self.start_level, self.backbone_end_level):
                     temp = []
-                    for _ in range(i - j):
+                    num_convs = i - j
+                    if self.collapse_downsample and i - j > 1:
+                        # ceil_mode keeps the sizes of the stride-2 chain
+                        temp.append(nn.AvgPool2d(2**(i - j - 1), ceil_mode=True))
+                        num_convs = 1
+                    for _ in range(num_convs):
                         temp.append(ConvModule(
                             out_channels,
                             out_channels,
@@ -281,17 +325,119 @@ class Attention(nn.Module):
                     inplace=False)
                 self.fpn_convs.append(extra_fpn_conv)
 
+        # with shared output convs and a single repeat, no output conv is
+        # built (the last repeat never gets one), so the outputs of the
+        # original levels are the fused laterals themselves
+        self._skip_final_fpn = self.out_sharing and self.repeated_layer == 1
+
+        if self.channels_last:
+            self.to(memory_format=torch.channels_last)
+
     # default init_weights for conv(msra) and norm in ConvModule
     def init_weights(self):
         """Initialize the weights of FPN module."""
+        # AugmentedConvs initialize their fused and grouped convs per slice
+        augmented_modules = set()
         for m in self.modules():
-            if isinstance(m, nn.Conv2d):
+            if isinstance(m, AugmentedConv):
+                m.init_weights()
+                augmented_modules.update(m.modules())
+        for m in self.modules():
+            if isinstance(m, nn.Conv2d) and m not in augmented_modules:
                 xavier_init(m, distribution='uniform')
 
+        # Script after initialization, since `init_weights` cannot see the
+        # `nn.Conv2d`s inside a compiled module.
+        if self.script_attention:
+            for fusion_attentions in self.fusion_attentions:
+                for i, fusion_attention in enumerate(fusion_attentions):
+                    if not isinstance(fusion_attention, torch.jit.ScriptModule):
+                        fusion_attentions[i] = torch.jit.script(fusion_attention)
+
+    def _load_from_state_dict(self, state_dict, prefix, local_metadata, strict,
+                              missing_keys, unexpected_keys, error_msgs):
+        """Upgrade the keys of old checkpoints for the scripted fusion
+        attentions, which lose their own `_load_from_state_dict` to
+        TorchScript."""
+        if self.script_attention:
+            for r, fusion_attentions in enumerate(self.fusion_attentions):
+                for i in range(len(fusion_attentions)):
+                    attention_prefix = f'{prefix}fusion_attentions.{r}.{i}.'
+                    AugmentedAttention.upgrade_state_dict(
+                        state_dict, attention_prefix)
+                    AugmentedConv.upgrade_state_dict(
+                        state_dict, f'{attention_prefix}augmented.')
+        super()._load_from_state_dict(state_dict, prefix, local_metadata,
+                                      strict, missing_keys, unexpected_keys,
+                                      error_msgs)
+
+    def _fuse_level(self, laterals, sizes, downsample_convs, fusion_attention,
+                    i):
+        """Resample every lateral to level ``i`` and fuse them with
+        ``fusion_attention``.
+
+        ``sizes`` holds the spatial size of each level, which does not change
+        across repeats, and ``downsample_convs`` the downsample paths of
+        level ``i`` for the current repeat.
+        """
+        used_backbone_levels = len(laterals)
+        size = sizes[i]
+
+        samples = [downsample_convs[j](laterals[j]) for j in range(i)]
+        samples.append(laterals[i])
+        samples.extend([
+            F.interpolate(
+                laterals[j],
+                size=size,
+                mode=self._upsample_mode,
+                align_corners=self._upsample_align_corners)
+            for j in range(i + 1, used_backbone_levels)
+        ])
+        fused = fusion_attention(samples)
+        if self.residual:
+            fused = fused + laterals[i]
+        return fused
+
+    def _top_down(self, laterals):
+        """Add each upsampled level to the one below it, in place."""
+        used_backbone_levels = len(laterals)
+        for i in range(used_backbone_levels - 1, 0, -1):
+            # In some cases, fixing `scale factor` (e.g. 2) is preferred, but
+            #  it cannot co-exist with `size` in `F.interpolate`.
+            if self._use_scale_factor:
+                laterals[i - 1] += F.interpolate(
+                    laterals[i],
+                    scale_factor=self._upsample_scale,
+                    mode=self._upsample_mode,
+                    align_corners=self._upsample_align_corners)
+            else:
+                laterals[i - 1] += F.interpolate(
+                    laterals[i],
+                    size=laterals[i - 1].shape[2:],
+                    mode=self._upsample_mode,
+                    align_corners=self._upsample_align_corners)
+
+    def _show_laterals(self, laterals):
+        """Plot the first 9 channels of the first image for each level."""
+        # matplotlib is only needed for debugging, so keep it out of the
+        # module import path of every training worker
+        import matplotlib.pyplot as plt
+        for lateral in laterals:
+            lateral_cpu = lateral[0, :9].detach().cpu()
+            fig, axarr = plt.subplots(3, 3)
+            for idx in range(9):
+                axarr[idx // 3][idx % 3].imshow(lateral_cpu[idx])
+            plt.show()
+
     @auto_fp16()
     def forward(self, inputs):
         """Forward function."""
         assert len(inputs) == len(self.in_channels)
+        if self.channels_last:
+            inputs = [
+                x.contiguous(memory_format=torch.channels_last)
+                for x in inputs
+            ]
 
         # build laterals
         laterals = [
@@ -300,81 +446,42 @@ class Attention(nn.Module):
         ]
 
         if self.viz:
-            for lateral in laterals:
-                fig, axarr = plt.subplots(3, 3)
-                for idx in range(9):
-                    axarr[idx // 3][idx % 3].imshow(lateral.squeeze()[idx].squeeze().cpu())
-                plt.show()
+            self._show_laterals(laterals)
 
         if 'before' in self.add_fpn:
-            # build top-down path
-            used_backbone_levels = len(laterals)
-            for i in range(used_backbone_levels - 1, 0, -1):
-                # In some cases, fixing `scale factor` (e.g. 2) is preferred, but
-                #  it cannot co-exist with `size` in `F.interpolate`.
-                if 'scale_factor' in self.upsample_cfg:
-                    laterals[i - 1] += F.interpolate(laterals[i],
-                                                     **self.upsample_cfg)
-                else:
-                    prev_shape = laterals[i - 1].shape[2:]
-                    laterals[i - 1] += F.interpolate(
-                        laterals[i], size=prev_shape, **self.upsample_cfg)
+            self._top_down(laterals)
 
         # build top-down path
         used_backbone_levels = len(laterals)
+        sizes = [tuple(lateral.shape[2:]) for lateral in laterals]
         for l in range(self.repeated_layer):
-            temps = []
-            for i in range(used_backbone_levels):
-                shape = laterals[i].shape[2:]
-                samples = []
-                down_l = l
-                attention_l = l
-                out_l = l
-                if self.down_sharing:
-                    down_l = 0
-                if self.attention_sharing:
-                    attention_l = 0
-                if self.out_sharing:
-                    out_l = 0
-                samples.extend([self.downsample_convs[down_l][i][j](laterals[j]) for j in
-                                range(i)])
-                samples.append(laterals[i])
-                samples.extend([F.interpolate(laterals[j], size=shape, **self.upsample_cfg) for j in
-                                range(i + 1, used_backbone_levels)])
-                if self.residual:
-                    temps.append(self.fusion_attentions[attention_l][i](samples) + laterals[i])
-                else:
-                    temps.append(self.fusion_attentions[attention_l][i](samples))
+            # resolve the shared modules once per repeat, not per level
+            downsample_convs = self.downsample_convs[0 if self.down_sharing else l]
+            fusion_attentions = self.fusion_attentions[0 if self.attention_sharing else l]
+            temps = [
+                self._fuse_level(laterals, sizes, downsample_convs[i],
+                                 fusion_attentions[i], i)
+                for i in range(used_backbone_levels)
+            ]
             if l != self.repeated_layer - 1:
+                repeated_convs = self.repeated_convs[0 if self.out_sharing else l]
                 laterals = [
-                    self.repeated_convs[out_l][i](temps[i]) for i in range(used_backbone_levels)
+                    repeated_conv(temp)
+                    for repeated_conv, temp in zip(repeated_convs, temps)
                 ]
             else:
-                laterals = [temps[j] for j in range(used_backbone_levels)]
+                laterals = temps
 
         if 'after' in self.add_fpn:
-            # build top-down path
-            used_backbone_levels = len(laterals)
-            for i in range(used_backbone_levels - 1, 0, -1):
-                # In some cases, fixing `scale factor` (e.g. 2) is preferred, but
-                #  it cannot co-exist with `size` in `F.interpolate`.
-                if 'scale_factor' in self.upsample_cfg:
-                    laterals[i - 1] += F.interpolate(laterals[i],
-                                                     **self.upsample_cfg)
-                else:
-                    prev_shape = laterals[i - 1].shape[2:]
-                    laterals[i - 1] += F.interpolate(
-                        laterals[i], size=prev_shape, **self.upsample_cfg)
+            self._top_down(laterals)
 
         if self.viz:
-            for lateral in laterals:
-                fig, axarr = plt.subplots(3, 3)
-                for idx in range(9):
-                    axarr[idx // 3][idx % 3].imshow(lateral.squeeze()[idx].squeeze().cpu())
-                plt.show()
+            self._show_laterals(laterals)
         # build outputs+
         # part 1: from original levels
-        if self.out_sharing:
+        if self._skip_final_fpn:
+            outs = list(laterals)
+        elif self.out_sharing:
             outs = [
                 self.repeated_convs[0][i](laterals[i]) for i in range(used_backbone_levels)
             ]
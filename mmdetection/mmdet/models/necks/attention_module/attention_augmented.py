@@ -1,10 +1,44 @@
+import re
+from collections import defaultdict
+from typing import List, Optional
+
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
 
 
+def _build_rel_index(length):
+    """Index that gathers the absolute logits out of the relative ones.
+
+    Relative logits of shape (..., L, 2L - 1) hold the logit between
+    position i and every offset from -(L - 1) to L - 1. The returned (L, L)
+    index picks offset j - i for every pair (i, j).
+    """
+    position = torch.arange(length)
+    return position[None, :] - position[:, None] + length - 1
+
+
 class AugmentedConv(nn.Module):
-    def __init__(self, in_channels, out_channels, kernel_size=3, dk=40, dv=4, Nh=4, shape=8, relative=False, stride=4):
+    # `groups` independent augmented convolutions over the same input are
+    # computed together: the convolutions are widened by `groups` and the
+    # groups are treated as extra attention heads. The output holds the
+    # `out_channels` of each group one after another.
+    #
+    # With `bf16=True` the attention itself (qkv matmuls, softmax and the
+    # relative logits) runs under bfloat16 autocast, the convolutions do not.
+    # TorchScript ignores autocast, so a scripted module runs in fp32.
+    #
+    # `relative`, `use_sdpa` and `bf16` are constants so TorchScript can drop
+    # the branches that read `key_rel_wh` and `rel_index` when they are not
+    # registered and call `F.scaled_dot_product_attention` or `torch.autocast`
+    # on PyTorch versions without them.
+    __constants__ = ['relative', 'use_sdpa', 'bf16']
+    # Version 1 had separate `conv_out` and `qkv_conv` convolutions and
+    # separate `key_rel_w` and `key_rel_h` embeddings.
+    _version = 2
+
+    def __init__(self, in_channels, out_channels, kernel_size=3, dk=40, dv=4, Nh=4, shape=8, relative=False, stride=4,
+                 groups=1, bf16=False):
         super(AugmentedConv, self).__init__()
         self.in_channels = in_channels
         self.out_channels = out_channels
@@ -15,75 +49,190 @@ class AugmentedConv(nn.Module):
         self.shape = shape
         self.relative = relative
         self.stride = stride
+        self.groups = groups
+        self.bf16 = bf16
         self.padding = (self.kernel_size - 1) // 2
+        # fused attention kernels are only available from PyTorch 2.0
+        self.use_sdpa = hasattr(F, 'scaled_dot_product_attention')
 
         assert self.Nh != 0, "integer division or modulo by zero, Nh >= 1"
         assert self.dk % self.Nh == 0, "dk should be divided by Nh. (example: out_channels: 20, dk: 40, Nh: 4)"
         assert self.dv % self.Nh == 0, "dv should be divided by Nh. (example: out_channels: 20, dv: 4, Nh: 4)"
         assert stride in [1, 2, 3,4], str(stride) + " Up to 2 strides are allowed."
+        assert not self.relative or self.groups == 1, "relative logits are only supported with groups=1."
+        assert not self.bf16 or hasattr(torch, 'autocast'), "bf16 attention requires torch.autocast (PyTorch >= 1.10)."
 
-        self.conv_out = nn.Conv2d(self.in_channels, self.out_channels - self.dv, self.kernel_size, stride=stride, padding=self.padding)
-
-        self.qkv_conv = nn.Conv2d(self.in_channels, 2 * self.dk + self.dv, kernel_size=self.kernel_size, stride=stride, padding=self.padding)
+        # conv_out and the qkv convolution share the input and the geometry,
+        # so they are computed by one convolution and split afterwards
+        self.conv_out_channels = (self.out_channels - self.dv) * groups
+        self.qkv_channels = (2 * self.dk + self.dv) * groups
+        self.fused_conv = nn.Conv2d(self.in_channels, self.conv_out_channels + self.qkv_channels, self.kernel_size,
+                                    stride=stride, padding=self.padding)
 
-        self.attn_out = nn.Conv2d(self.dv, self.dv, kernel_size=1, stride=1)
+        self.attn_out = nn.Conv2d(self.dv * groups, self.dv * groups, kernel_size=1, stride=1, groups=groups)
 
         if self.relative:
-            self.key_rel_w = nn.Parameter(torch.randn((2 * self.shape - 1, dk // Nh), requires_grad=True))
-            self.key_rel_h = nn.Parameter(torch.randn((2 * self.shape - 1, dk // Nh), requires_grad=True))
+            # the width (index 0) and height (index 1) embeddings are stored
+            # together so both relative logits come out of a single einsum
+            self.key_rel_wh = nn.Parameter(torch.randn((2, 2 * self.shape - 1, dk // Nh), requires_grad=True))
+            # derived from `shape`, so it is not saved with the weights
+            self.register_buffer(
+                'rel_index', _build_rel_index(self.shape), persistent=False)
 
-    def forward(self, x):
+    def init_weights(self):
+        """Xavier-initialize every group and part of the convolutions.
+
+        Each `conv_out` and `qkv` group of `fused_conv` and each group of
+        `attn_out` stands for a separate convolution of version 1, so it gets
+        the uniform xavier bound of that convolution instead of the smaller
+        bound of the whole fused and widened one.
+        """
+        # the slices are views, which autograd only lets us fill in place
+        # when they are taken without grad
+        with torch.no_grad():
+            conv_out_weight, qkv_weight = torch.split(
+                self.fused_conv.weight,
+                [self.conv_out_channels, self.qkv_channels])
+            for weight in (conv_out_weight, qkv_weight, self.attn_out.weight):
+                for group_weight in weight.chunk(self.groups):
+                    nn.init.xavier_uniform_(group_weight)
+        nn.init.constant_(self.fused_conv.bias, 0)
+        nn.init.constant_(self.attn_out.bias, 0)
+
+    @staticmethod
+    def upgrade_state_dict(state_dict, prefix):
+        """Rename the version 1 weights of `state_dict` to the current
+        layout, in place.
+
+        The `conv_out` and `qkv_conv` weights are concatenated, in that
+        order, into the `fused_conv` weights and `key_rel_w` and `key_rel_h`
+        are stacked, in that order, into `key_rel_wh`.
+        """
+        for param in ('weight', 'bias'):
+            conv_out_key = f'{prefix}conv_out.{param}'
+            qkv_conv_key = f'{prefix}qkv_conv.{param}'
+            if conv_out_key in state_dict and qkv_conv_key in state_dict:
+                state_dict[f'{prefix}fused_conv.{param}'] = torch.cat(
+                    (state_dict.pop(conv_out_key),
+                     state_dict.pop(qkv_conv_key)), dim=0)
+        key_rel_w_key = f'{prefix}key_rel_w'
+        key_rel_h_key = f'{prefix}key_rel_h'
+        if key_rel_w_key in state_dict and key_rel_h_key in state_dict:
+            state_dict[f'{prefix}key_rel_wh'] = torch.stack(
+                (state_dict.pop(key_rel_w_key),
+                 state_dict.pop(key_rel_h_key)), dim=0)
+
+    def _load_from_state_dict(self, state_dict, prefix, local_metadata, strict,
+                              missing_keys, unexpected_keys, error_msgs):
+        """Upgrade the keys of version 1 checkpoints before loading them."""
+        version = local_metadata.get('version', None)
+        if version is None or version < 2:
+            self.upgrade_state_dict(state_dict, prefix)
+        super()._load_from_state_dict(state_dict, prefix, local_metadata,
+                                      strict, missing_keys, unexpected_keys,
+                                      error_msgs)
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
         # Input x
         # (batch_size, channels, height, width)
         batch_x, _, height_x, width_x = x.size()
 
         # conv_out
-        # (batch_size, out_channels, height, width)
-        conv_out = self.conv_out(x)
+        # (batch_size, groups * (out_channels - dv), height, width)
+        # qkv
+        # (batch_size, groups * (2 * dk + dv), height, width)
+        conv_out, qkv = torch.split(self.fused_conv(x), [self.conv_out_channels, self.qkv_channels], dim=1)
         batch, _, height, width = conv_out.size()
+        heads = self.groups * self.Nh
 
         # flat_q, flat_k, flat_v
-        # (batch_size, Nh, height * width, dvh or dkh)
+        # (batch_size, groups * Nh, height * width, dvh or dkh)
         # dvh = dv / Nh, dkh = dk / Nh
         # q, k, v
-        # (batch_size, Nh, height, width, dv or dk)
-        flat_q, flat_k, flat_v, q, k, v = self.compute_flat_qkv(x, self.dk, self.dv, self.Nh)
-        logits = torch.matmul(flat_q.transpose(2, 3), flat_k) # (4,4,1600,10) * (4,4,10,1600)
-        if self.relative:
-            h_rel_logits, w_rel_logits = self.relative_logits(q)
-            logits += h_rel_logits
-            logits += w_rel_logits
-        weights = F.softmax(logits, dim=-1) # (4, 4, 1600, 1600)
+        # (batch_size, groups * Nh, height, width, dv or dk)
+        flat_q, flat_k, flat_v, q, k, v = self.compute_flat_qkv(qkv, self.dk, self.dv, self.Nh)
 
         # attn_out
-        # (batch, Nh, height * width, dvh)
-        attn_out = torch.matmul(weights, flat_v.transpose(2, 3)) # (4,4,1600,1)
-        attn_out = torch.reshape(attn_out, (batch, self.Nh, self.dv // self.Nh, height, width)) # (4, 4, 1, 40, 40)
+        # (batch, groups * Nh, height * width, dvh)
+        if self.bf16:
+            # TorchScript only accepts a constant autocast device
+            if x.is_cuda:
+                with torch.autocast('cuda', dtype=torch.bfloat16):
+                    attn_out = self.compute_attention(flat_q, flat_k, flat_v, q)
+            else:
+                with torch.autocast('cpu', dtype=torch.bfloat16):
+                    attn_out = self.compute_attention(flat_q, flat_k, flat_v, q)
+            attn_out = attn_out.to(conv_out.dtype)
+        else:
+            attn_out = self.compute_attention(flat_q, flat_k, flat_v, q)
+        attn_out = torch.reshape(attn_out, (batch, heads, self.dv // self.Nh, height, width)) # (4, 4, 1, 40, 40)
         # combine_heads_2d
-        # (batch, out_channels, height, width)
+        # (batch, groups * dv, height, width)
         attn_out = self.combine_heads_2d(attn_out) # (4, 4, 40, 40)
         attn_out = self.attn_out(attn_out) # (4, 4, 40, 40)
-        attention = torch.cat((conv_out, attn_out), dim=1)
+        # (batch, groups * out_channels, height, width)
+        attention = torch.cat((conv_out.view(batch, self.groups, -1, height, width),
+                               attn_out.view(batch, self.groups, -1, height, width)), dim=2)
+        attention = attention.view(batch, -1, height, width)
 
         attention = F.interpolate(attention, size=(height_x, width_x),mode = 'bilinear', align_corners = True)
         return attention
 
-    def compute_flat_qkv(self, x, dk, dv, Nh):
-        qkv = self.qkv_conv(x)
+    def compute_attention(self, flat_q: torch.Tensor, flat_k: torch.Tensor, flat_v: torch.Tensor, q: torch.Tensor):
+        batch, heads, _, height, width = q.size()
+        scale = (self.dk // self.Nh) ** -0.5
+
+        if self.use_sdpa:
+            # the (batch, groups * Nh, height * width, height * width) weights
+            # are never materialized without relative logits; the default
+            # scale of SDPA is dkh ** -0.5
+            attn_mask: Optional[torch.Tensor] = None
+            if self.relative:
+                h_rel_logits, w_rel_logits = self.relative_logits(q, scale)
+                attn_mask = (h_rel_logits + w_rel_logits).reshape(batch, heads, height * width, height * width)
+            attn_out = F.scaled_dot_product_attention(flat_q.transpose(2, 3), flat_k.transpose(2, 3),
+                                                      flat_v.transpose(2, 3), attn_mask=attn_mask)
+        else:
+            # merge batch and heads so the products are plain batched GEMMs;
+            # the dkh ** -0.5 scale is applied by the GEMM through alpha
+            dkh = flat_q.size(2)
+            hw = height * width
+            logits = torch.baddbmm(flat_q.new_zeros(1, 1, 1),
+                                   flat_q.transpose(2, 3).reshape(batch * heads, hw, dkh),
+                                   flat_k.reshape(batch * heads, dkh, hw),
+                                   beta=0, alpha=scale) # (16,1600,10) * (16,10,1600)
+            logits = logits.view(batch, heads, hw, hw)
+            if self.relative:
+                h_rel_logits, w_rel_logits = self.relative_logits(q, scale)
+                # the relative logits broadcast over one spatial axis, so add
+                # them through a (batch, heads, height, width, height, width)
+                # view
+                logits_6d = logits.view(batch, heads, height, width, height, width)
+                logits_6d += h_rel_logits
+                logits_6d += w_rel_logits
+            weights = F.softmax(logits, dim=-1) # (4, 4, 1600, 1600)
+            dvh = flat_v.size(2)
+            attn_out = torch.bmm(weights.view(batch * heads, hw, hw),
+                                 flat_v.transpose(2, 3).reshape(batch * heads, hw, dvh)) # (16,1600,1)
+            attn_out = attn_out.view(batch, heads, hw, dvh)
+        return attn_out
+
+    def compute_flat_qkv(self, qkv: torch.Tensor, dk: int, dv: int, Nh: int):
         N, _, H, W = qkv.size() # (B, 84, 40, 40)
-        q, k, v = torch.split(qkv, [dk, dk, dv], dim=1)
-        q = self.split_heads_2d(q, Nh)
-        k = self.split_heads_2d(k, Nh)
-        v = self.split_heads_2d(v, Nh)
-
-        dkh = dk // Nh
-        q *= dkh ** -0.5
-        flat_q = torch.reshape(q, (N, Nh, dk // Nh, H * W)) # (4, 4, 10, 1600)
-        flat_k = torch.reshape(k, (N, Nh, dk // Nh, H * W)) # (4, 4, 10, 1600)
-        flat_v = torch.reshape(v, (N, Nh, dv // Nh, H * W)) # (4, 4, 1, 1600)
+        G = self.groups
+        qkv = qkv.view(N, G, 2 * dk + dv, H, W)
+        q, k, v = torch.split(qkv, [dk, dk, dv], dim=2)
+        # the heads of every group are laid out one group after another
+        q = self.split_heads_2d(q.reshape(N, G * dk, H, W), G * Nh)
+        k = self.split_heads_2d(k.reshape(N, G * dk, H, W), G * Nh)
+        v = self.split_heads_2d(v.reshape(N, G * dv, H, W), G * Nh)
+
+        flat_q = torch.reshape(q, (N, G * Nh, dk // Nh, H * W)) # (4, 4, 10, 1600)
+        flat_k = torch.reshape(k, (N, G * Nh, dk // Nh, H * W)) # (4, 4, 10, 1600)
+        flat_v = torch.reshape(v, (N, G * Nh, dv // Nh, H * W)) # (4, 4, 1, 1600)
         return flat_q, flat_k, flat_v, q, k, v
 
-    def split_heads_2d(self, x, Nh):
+    def split_heads_2d(self, x: torch.Tensor, Nh: int):
         batch, channels, height, width = x.size()
         ret_shape = (batch, Nh, channels // Nh, height, width)
         split = torch.reshape(x, ret_shape)
@@ -94,69 +243,102 @@ class AugmentedConv(nn.Module):
         ret_shape = (batch, Nh * dv, H, W)
         return torch.reshape(x, ret_shape)
 
-    def relative_logits(self, q):
+    def relative_logits(self, q: torch.Tensor, scale: float):
+        # the logits are linear in q, so `scale` is applied to the small
+        # (2, 2 * shape - 1, dkh) embeddings rather than to q
         B, Nh, dk, H, W = q.size()
         q = torch.transpose(q, 2, 4).transpose(2, 3)
 
-        rel_logits_w = self.relative_logits_1d(q, self.key_rel_w, H, W, Nh, "w")
-        rel_logits_h = self.relative_logits_1d(torch.transpose(q, 2, 3), self.key_rel_h, W, H, Nh, "h")
+        # (2, B, Nh, H, W, 2 * shape - 1), width then height
+        rel_logits = torch.einsum('bhxyd,cmd->cbhxym', q, self.key_rel_wh * scale)
+        rel_logits_w = self.relative_logits_1d(rel_logits[0], H, W, Nh, "w")
+        # the height logits are computed along the transposed spatial axes
+        rel_logits_h = self.relative_logits_1d(torch.transpose(rel_logits[1], 2, 3), W, H, Nh, "h")
 
         return rel_logits_h, rel_logits_w
 
-    def relative_logits_1d(self, q, rel_k, H, W, Nh, case):
-        rel_logits = torch.einsum('bhxyd,md->bhxym', q, rel_k)
+    def relative_logits_1d(self, rel_logits: torch.Tensor, H: int, W: int, Nh: int, case: str):
         rel_logits = torch.reshape(rel_logits, (-1, Nh * H, W, 2 * W - 1))
         rel_logits = self.rel_to_abs(rel_logits)
 
         rel_logits = torch.reshape(rel_logits, (-1, Nh, H, W, W))
-        rel_logits = torch.unsqueeze(rel_logits, dim=3)
-        rel_logits = rel_logits.repeat((1, 1, 1, H, 1, 1))
 
+        # Return a broadcastable view instead of repeating the logits H times.
+        # Both cases line up with logits viewed as
+        # (B, Nh, height, width, height, width): "w" gives
+        # (B, Nh, height, width, 1, width) and "h", whose H and W arguments
+        # are swapped, gives (B, Nh, height, width, height, 1).
         if case == "w":
-            rel_logits = torch.transpose(rel_logits, 3, 4)
-        elif case == "h":
-            rel_logits = torch.transpose(rel_logits, 2, 4).transpose(4, 5).transpose(3, 5)
-        rel_logits = torch.reshape(rel_logits, (-1, Nh, H * W, H * W))
+            rel_logits = torch.unsqueeze(rel_logits, dim=4)
+        else:
+            rel_logits = torch.unsqueeze(rel_logits.permute(0, 1, 3, 2, 4), dim=5)
         return rel_logits
 
     def rel_to_abs(self, x):
+        # (B, Nh, L, 2L - 1) -> (B, Nh, L, L), L is always `shape`
         B, Nh, L, _ = x.size()
-
-        col_pad = torch.zeros((B, Nh, L, 1)).to(x)
-        x = torch.cat((x, col_pad), dim=3)
-
-        flat_x = torch.reshape(x, (B, Nh, L * 2 * L))
-        flat_pad = torch.zeros((B, Nh, L - 1)).to(x)
-        flat_x_padded = torch.cat((flat_x, flat_pad), dim=2)
-
-        final_x = torch.reshape(flat_x_padded, (B, Nh, L + 1, 2 * L - 1))
-        final_x = final_x[:, :, :L, L - 1:]
-        return final_x
+        return torch.gather(x, 3, self.rel_index.expand(B, Nh, L, L))
 
 class AugmentedAttention(nn.Module):
-    def __init__(self, levels, in_channels, out_channels, map_repeated):
+    # Version 1 had one `augmented.<repeat>.<level>` AugmentedConv per repeat
+    # and level, version 2 computes all of them with one grouped AugmentedConv.
+    _version = 2
+
+    def __init__(self, levels, in_channels, out_channels, map_repeated, bf16=False):
         super(AugmentedAttention, self).__init__()
         self.levels = levels
         self.in_channels = in_channels
         self.out_channels = out_channels
         self.map_repeated = map_repeated
+        self.bf16 = bf16
+
+        # a single AugmentedConv computes the maps of every repeat and level:
+        # one fused convolution and one attention instead of one per repeat
+        self.augmented = AugmentedConv(in_channels, out_channels, groups=map_repeated * levels, bf16=bf16)
+
+    @staticmethod
+    def upgrade_state_dict(state_dict, prefix):
+        """Merge the `augmented.<repeat>.<level>.*` weights of version 1 into
+        the `augmented.*` weights of the grouped AugmentedConv, in place.
 
-        self.augmented = nn.ModuleList()
-        for i in range(map_repeated):
-            self.augmented.append(nn.ModuleList())
-            for _ in range(levels):
-                self.augmented[i].append(AugmentedConv(in_channels, out_channels))
+        Group ``repeat * levels + level`` holds the weights of that repeat and
+        level, so they are concatenated in that order. Their layout within
+        the AugmentedConv is upgraded by its own `_load_from_state_dict`.
+        """
+        pattern = re.compile(
+            re.escape(prefix) + r'augmented\.(\d+)\.(\d+)\.(.+)$')
+        merged = defaultdict(dict)
+        for key in list(state_dict.keys()):
+            match = pattern.match(key)
+            if match is not None:
+                repeat, level, name = match.groups()
+                merged[name][(int(repeat), int(level))] = state_dict.pop(key)
+        for name, weights in merged.items():
+            state_dict[f'{prefix}augmented.{name}'] = torch.cat(
+                [weights[group] for group in sorted(weights)], dim=0)
 
-    def forward(self, x) :
-        outs = x
+    def _load_from_state_dict(self, state_dict, prefix, local_metadata, strict,
+                              missing_keys, unexpected_keys, error_msgs):
+        """Upgrade the keys of version 1 checkpoints before loading them."""
+        version = local_metadata.get('version', None)
+        if version is None or version < 2:
+            self.upgrade_state_dict(state_dict, prefix)
+        super()._load_from_state_dict(state_dict, prefix, local_metadata,
+                                      strict, missing_keys, unexpected_keys,
+                                      error_msgs)
+
+    def forward(self, x: List[torch.Tensor]) -> torch.Tensor:
         x = torch.cat(x, dim=1)
         # (4,256,54,54)
+        batch, _, height, width = x.size()
+
+        # (batch, map_repeated * levels * out_channels, height, width)
+        attention = self.augmented(x)
+        # sum the repeats, leaving (batch, levels * out_channels, height,
+        # width) laid out like x
+        if self.map_repeated > 1:
+            attention = attention.view(batch, self.map_repeated, -1, height, width).sum(dim=1)
 
-        attention_maps = [self.augmented[0][j](x) for j in range(self.levels)]
-        for repeated in range(1, self.map_repeated):
-            attention_maps2 = [self.augmented[repeated][j](x) for j in range(self.levels)]
-            attention_maps = [maps + maps2 for maps, maps2 in zip(attention_maps, attention_maps2)]
-        
-        outs = [outs[level] * attention_maps[level] for level in range(self.levels)]
-        
-        return sum(outs)
\ No newline at end of file
+        # weight every level by its map and sum over the levels in one pass
+        out = (x * attention).view(batch, self.levels, -1, height, width)
+        return out.sum(dim=1)
@@ -1,7 +1,6 @@
 import torch
 from mmcv.cnn import constant_init, kaiming_init
 from torch import nn
-import matplotlib.pyplot as plt
 
 
 def last_zero_init(m):
@@ -158,6 +157,7 @@ class ContextBlock(nn.Module):
                         mul_maps = [torch.sigmoid(self.channel_mul_conv[repeat][i](torch.cat(mul_maps, dim=1)))
                                     for i in range(self.levels)]
             if self.viz:
+                import matplotlib.pyplot as plt
                 for i, (out, mul_map) in enumerate(zip(outs, mul_maps)):
                     import numpy as np
                     height = mul_map[0].squeeze().cpu().numpy()
@@ -221,6 +221,7 @@ class ContextBlock(nn.Module):
                     w /= (w.sum() + self.eps)
                     add_maps = [add_maps[i] * w[i] for i in range(self.levels)]
             if self.viz:
+                import matplotlib.pyplot as plt
                 for i, (out, mul_map) in enumerate(zip(outs, add_maps)):
                     import numpy as np
                     height = mul_map[0].squeeze().cpu().numpy()
@@ -1,7 +1,6 @@
 import torch
 from mmcv.cnn import constant_init, kaiming_init
 from torch import nn
-import matplotlib.pyplot as plt
 
 
 def last_zero_init(m):
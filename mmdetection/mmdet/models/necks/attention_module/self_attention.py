@@ -111,12 +111,11 @@ class SelfAttentionBlock(nn.Module):
     def rel_to_abs(self, x):
         B, Nh, L, _ = x.size()
 
-        col_pad = torch.zeros((B, Nh, L, 1)).to(x)
-        x = torch.cat((x, col_pad), dim=3)
+        # zero-pad in place of concatenating freshly allocated zero tensors
+        x = F.pad(x, (0, 1))
 
         flat_x = torch.reshape(x, (B, Nh, L * 2 * L))
-        flat_pad = torch.zeros((B, Nh, L - 1)).to(x)
-        flat_x_padded = torch.cat((flat_x, flat_pad), dim=2)
+        flat_x_padded = F.pad(flat_x, (0, L - 1))
 
         final_x = torch.reshape(flat_x_padded, (B, Nh, L + 1, 2 * L - 1))
         final_x = final_x[:, :, :L, L - 1:]
@@ -1,8 +1,11 @@
 import pytest
 import torch
+import torch.nn.functional as F
 from torch.nn.modules.batchnorm import _BatchNorm
 
-from mmdet.models.necks import FPN, ChannelMapper
+from mmdet.models.necks import FPN, Attention, ChannelMapper
+from mmdet.models.necks.attention_module.attention_augmented import \
+    AugmentedConv
 
 
 def test_fpn():
@@ -236,3 +239,385 @@ def test_channel_mapper():
     for i in range(len(feats)):
         outs[i].shape[1] == out_channels
         outs[i].shape[2] == outs[i].shape[3] == s // (2**i)
+
+
+def test_attention():
+    """Tests Attention."""
+    s = 32
+    in_channels = [8, 16, 32, 64]
+    feat_sizes = [s // 2**i for i in range(4)]  # [32, 16, 8, 4]
+    out_channels = 8
+
+    # TorchScript ignores the autocast of the bf16 attention
+    with pytest.raises(AssertionError):
+        Attention(
+            in_channels=in_channels,
+            out_channels=out_channels,
+            num_outs=5,
+            attention_type='augmented',
+            script_attention=True,
+            bf16_attention=True)
+
+    # Only mode, align_corners and scale_factor are passed to F.interpolate
+    with pytest.raises(AssertionError):
+        Attention(
+            in_channels=in_channels,
+            out_channels=out_channels,
+            num_outs=5,
+            upsample_cfg=dict(mode='nearest', recompute_scale_factor=True))
+
+    feats = [
+        torch.rand(1, in_channels[i], feat_sizes[i], feat_sizes[i])
+        for i in range(len(in_channels))
+    ]
+
+    # Shared output convs with a single repeat return the fused laterals
+    attention_model = Attention(
+        in_channels=in_channels,
+        out_channels=out_channels,
+        num_outs=5,
+        out_sharing=True)
+    outs = attention_model(feats)
+    assert len(outs) == attention_model.num_outs
+    for i in range(attention_model.num_outs):
+        assert outs[i].shape == (1, out_channels, s // 2**i, s // 2**i)
+
+    # Collapsed downsample paths match the sizes of the stride-2 conv chain,
+    # which rounds odd sizes up
+    odd_sizes = [37, 19, 10, 5]
+    odd_feats = [
+        torch.rand(1, in_channels[i], odd_sizes[i], odd_sizes[i])
+        for i in range(len(in_channels))
+    ]
+    attention_model = Attention(
+        in_channels=in_channels,
+        out_channels=out_channels,
+        num_outs=4,
+        collapse_downsample=True)
+    outs = attention_model(odd_feats)
+    assert len(outs) == attention_model.num_outs
+    for out, size in zip(outs, odd_sizes):
+        assert out.shape == (1, out_channels, size, size)
+
+    # channels_last only changes the memory format, not the outputs
+    attention_model = Attention(
+        in_channels=in_channels,
+        out_channels=out_channels,
+        num_outs=5,
+        attention_type='augmented').eval()
+    channels_last_model = Attention(
+        in_channels=in_channels,
+        out_channels=out_channels,
+        num_outs=5,
+        attention_type='augmented',
+        channels_last=True).eval()
+    channels_last_model.load_state_dict(attention_model.state_dict())
+    with torch.no_grad():
+        outs = attention_model(feats)
+        channels_last_outs = channels_last_model(feats)
+    for out, channels_last_out in zip(outs, channels_last_outs):
+        assert torch.allclose(out, channels_last_out, atol=1e-5)
+
+    # scripted fusion attentions give the outputs of the eager ones
+    scripted_model = Attention(
+        in_channels=in_channels,
+        out_channels=out_channels,
+        num_outs=5,
+        attention_type='augmented',
+        script_attention=True).eval()
+    scripted_model.init_weights()
+    assert isinstance(scripted_model.fusion_attentions[0][0],
+                      torch.jit.ScriptModule)
+    scripted_model.load_state_dict(attention_model.state_dict())
+    with torch.no_grad():
+        scripted_outs = scripted_model(feats)
+    for out, scripted_out in zip(outs, scripted_outs):
+        assert torch.allclose(out, scripted_out, atol=1e-5)
+
+
+@pytest.mark.skipif(
+    not hasattr(torch, 'autocast'), reason='requires torch.autocast')
+def test_attention_bf16():
+    """Tests the bfloat16 attention of the augmented Attention neck."""
+    s = 32
+    in_channels = [8, 16, 32, 64]
+    feat_sizes = [s // 2**i for i in range(4)]  # [32, 16, 8, 4]
+    out_channels = 8
+    feats = [
+        torch.rand(1, in_channels[i], feat_sizes[i], feat_sizes[i])
+        for i in range(len(in_channels))
+    ]
+
+    attention_model = Attention(
+        in_channels=in_channels,
+        out_channels=out_channels,
+        num_outs=5,
+        attention_type='augmented').eval()
+    bf16_model = Attention(
+        in_channels=in_channels,
+        out_channels=out_channels,
+        num_outs=5,
+        attention_type='augmented',
+        bf16_attention=True).eval()
+    bf16_model.load_state_dict(attention_model.state_dict())
+    with torch.no_grad():
+        outs = attention_model(feats)
+        bf16_outs = bf16_model(feats)
+    for out, bf16_out in zip(outs, bf16_outs):
+        assert bf16_out.dtype == torch.float32
+        assert torch.allclose(out, bf16_out, rtol=1e-2, atol=1e-2)
+
+    # the neck only builds grouped AugmentedConvs, which do not support the
+    # relative logits, so check those on a single AugmentedConv
+    x = torch.rand(1, 32, 32, 32)
+    for relative in (False, True):
+        augmented_conv = AugmentedConv(32, 8, relative=relative).eval()
+        bf16_conv = AugmentedConv(32, 8, relative=relative, bf16=True).eval()
+        bf16_conv.load_state_dict(augmented_conv.state_dict())
+        with torch.no_grad():
+            out = augmented_conv(x)
+            bf16_out = bf16_conv(x)
+        assert bf16_out.dtype == torch.float32
+        assert torch.allclose(out, bf16_out, rtol=1e-2, atol=1e-2)
+        # the attention did run in bfloat16
+        assert not torch.equal(out, bf16_out)
+
+
+def _assert_xavier_uniform(weight, fan_in, fan_out):
+    """Checks that ``weight`` is drawn with the xavier uniform bound of a
+    convolution with the given fans."""
+    bound = (6 / (fan_in + fan_out))**0.5
+    # the largest of n uniform draws falls below (1 - 8 / n) * bound with a
+    # probability of about exp(-8)
+    assert (1 - 8 / weight.numel()) * bound <= weight.abs().max() <= bound
+
+
+def test_augmented_attention_init_weights():
+    """Tests that the grouped AugmentedConv of the Attention neck keeps the
+    init of the version 1 per-level convs."""
+    torch.manual_seed(0)
+    in_channels = [8, 16, 32, 64]
+    out_channels = 8
+    levels = len(in_channels)
+
+    for map_repeated in (1, 2):
+        attention_model = Attention(
+            in_channels=in_channels,
+            out_channels=out_channels,
+            num_outs=5,
+            attention_type='augmented',
+            map_repeated=map_repeated)
+        attention_model.init_weights()
+        augmented_conv = attention_model.fusion_attentions[0][0].augmented
+        groups = map_repeated * levels
+        kernel_area = augmented_conv.kernel_size**2
+        dk, dv = augmented_conv.dk, augmented_conv.dv
+
+        conv_out_weight, qkv_weight = augmented_conv.fused_conv.weight.split([
+            augmented_conv.conv_out_channels, augmented_conv.qkv_channels
+        ])
+        for group in range(groups):
+            _assert_xavier_uniform(
+                conv_out_weight.chunk(groups)[group],
+                fan_in=levels * out_channels * kernel_area,
+                fan_out=(out_channels - dv) * kernel_area)
+            _assert_xavier_uniform(
+                qkv_weight.chunk(groups)[group],
+                fan_in=levels * out_channels * kernel_area,
+                fan_out=(2 * dk + dv) * kernel_area)
+            _assert_xavier_uniform(
+                augmented_conv.attn_out.weight.chunk(groups)[group],
+                fan_in=dv,
+                fan_out=dv)
+        assert not augmented_conv.fused_conv.bias.any()
+        assert not augmented_conv.attn_out.bias.any()
+
+
+def test_augmented_conv_init_weights():
+    """Tests that fused_conv keeps the init of the separate conv_out and
+    qkv_conv of version 1."""
+    torch.manual_seed(0)
+    augmented_conv = AugmentedConv(32, 8)
+    augmented_conv.init_weights()
+    kernel_area = augmented_conv.kernel_size**2
+    dk, dv = augmented_conv.dk, augmented_conv.dv
+
+    conv_out_weight, qkv_weight = augmented_conv.fused_conv.weight.split(
+        [augmented_conv.conv_out_channels, augmented_conv.qkv_channels])
+    _assert_xavier_uniform(
+        conv_out_weight,
+        fan_in=32 * kernel_area,
+        fan_out=(8 - dv) * kernel_area)
+    _assert_xavier_uniform(
+        qkv_weight,
+        fan_in=32 * kernel_area,
+        fan_out=(2 * dk + dv) * kernel_area)
+    _assert_xavier_uniform(
+        augmented_conv.attn_out.weight, fan_in=dv, fan_out=dv)
+
+
+def test_augmented_conv_explicit_attention():
+    """Tests the baddbmm/bmm attention used without
+    F.scaled_dot_product_attention against the default one."""
+    x = torch.rand(1, 32, 32, 32)
+    for relative, groups in ((False, 1), (True, 1), (False, 2)):
+        augmented_conv = AugmentedConv(
+            32, 8, relative=relative, groups=groups).eval()
+        with torch.no_grad():
+            out = augmented_conv(x)
+            augmented_conv.use_sdpa = False
+            explicit_out = augmented_conv(x)
+        assert torch.allclose(out, explicit_out, atol=1e-6)
+
+
+def _augmented_conv_v1(state_dict, x, dk=40, dv=4, Nh=4, stride=4):
+    """Plain version 1 AugmentedConv forward, which scaled q by dkh ** -0.5
+    before both the products and the relative logits."""
+    conv_out = F.conv2d(
+        x,
+        state_dict['conv_out.weight'],
+        state_dict['conv_out.bias'],
+        stride=stride,
+        padding=1)
+    qkv = F.conv2d(
+        x,
+        state_dict['qkv_conv.weight'],
+        state_dict['qkv_conv.bias'],
+        stride=stride,
+        padding=1)
+    batch, _, height, width = qkv.size()
+    q, k, v = [
+        t.reshape(batch, Nh, -1, height * width)
+        for t in qkv.split([dk, dk, dv], dim=1)
+    ]
+    q = q * (dk // Nh)**-0.5
+    logits = q.transpose(2, 3) @ k
+    if 'key_rel_w' in state_dict:
+        # row and column of every position, and the relative embeddings of
+        # every (query, key) pair
+        rows = torch.arange(height).repeat_interleave(width)
+        cols = torch.arange(width).repeat(height)
+        rel_h = state_dict['key_rel_h'][rows[None, :] - rows[:, None] +
+                                        height - 1]
+        rel_w = state_dict['key_rel_w'][cols[None, :] - cols[:, None] +
+                                        width - 1]
+        logits = logits + torch.einsum('bhdq,qkd->bhqk', q, rel_h + rel_w)
+    attn_out = logits.softmax(dim=-1) @ v.transpose(2, 3)
+    attn_out = F.conv2d(
+        attn_out.reshape(batch, dv, height, width),
+        state_dict['attn_out.weight'], state_dict['attn_out.bias'])
+    out = torch.cat((conv_out, attn_out), dim=1)
+    return F.interpolate(
+        out, size=x.shape[2:], mode='bilinear', align_corners=True)
+
+
+def test_augmented_conv_upgrade():
+    """Tests loading version 1 AugmentedConv checkpoints."""
+    for relative in (False, True):
+        augmented_conv = AugmentedConv(32, 8, relative=relative).eval()
+        state_dict = augmented_conv.state_dict()
+
+        # version 1 layout: separate conv_out/qkv_conv and key_rel_w/key_rel_h
+        old_state_dict = {}
+        for param in ('weight', 'bias'):
+            conv_out, qkv_conv = state_dict[f'fused_conv.{param}'].split([
+                augmented_conv.conv_out_channels, augmented_conv.qkv_channels
+            ])
+            old_state_dict[f'conv_out.{param}'] = conv_out
+            old_state_dict[f'qkv_conv.{param}'] = qkv_conv
+            old_state_dict[f'attn_out.{param}'] = state_dict[
+                f'attn_out.{param}']
+        if relative:
+            old_state_dict['key_rel_w'] = state_dict['key_rel_wh'][0]
+            old_state_dict['key_rel_h'] = state_dict['key_rel_wh'][1]
+
+        upgraded = AugmentedConv(32, 8, relative=relative).eval()
+        upgraded.load_state_dict(old_state_dict)
+        x = torch.rand(1, 32, 32, 32)
+        with torch.no_grad():
+            assert torch.allclose(augmented_conv(x), upgraded(x))
+
+            # both attention paths fold the dkh ** -0.5 scale into the
+            # products and the relative embeddings instead of scaling q
+            expected = _augmented_conv_v1(old_state_dict, x)
+            for use_sdpa in (upgraded.use_sdpa, False):
+                upgraded.use_sdpa = use_sdpa
+                assert torch.allclose(upgraded(x), expected, atol=1e-5)
+
+
+def test_augmented_attention_upgrade():
+    """Tests loading version 1 augmented Attention neck checkpoints."""
+    s = 32
+    in_channels = [8, 16, 32, 64]
+    feat_sizes = [s // 2**i for i in range(4)]  # [32, 16, 8, 4]
+    out_channels = 8
+    levels = len(in_channels)
+    feats = [
+        torch.rand(1, in_channels[i], feat_sizes[i], feat_sizes[i])
+        for i in range(len(in_channels))
+    ]
+
+    for map_repeated in (1, 2):
+        attention_model = Attention(
+            in_channels=in_channels,
+            out_channels=out_channels,
+            num_outs=5,
+            attention_type='augmented',
+            map_repeated=map_repeated).eval()
+        attention_model.init_weights()
+        augmented_conv = attention_model.fusion_attentions[0][0].augmented
+        groups = map_repeated * levels
+
+        # version 1 layout: one AugmentedConv per repeat and level, with
+        # separate conv_out and qkv_conv
+        old_state_dict = {}
+        for key, value in attention_model.state_dict().items():
+            prefix, sep, name = key.partition('.augmented.')
+            if not sep:
+                old_state_dict[key] = value
+                continue
+            module_name, param = name.split('.')
+            if module_name == 'fused_conv':
+                conv_out, qkv_conv = value.split([
+                    augmented_conv.conv_out_channels,
+                    augmented_conv.qkv_channels
+                ])
+                parts = dict(
+                    conv_out=conv_out.chunk(groups),
+                    qkv_conv=qkv_conv.chunk(groups))
+            else:
+                parts = {module_name: value.chunk(groups)}
+            for module_name, chunks in parts.items():
+                for group, chunk in enumerate(chunks):
+                    repeat, level = divmod(group, levels)
+                    old_state_dict[f'{prefix}.augmented.{repeat}.{level}.'
+                                   f'{module_name}.{param}'] = chunk
+
+        upgraded = Attention(
+            in_channels=in_channels,
+            out_channels=out_channels,
+            num_outs=5,
+            attention_type='augmented',
+            map_repeated=map_repeated).eval()
+        upgraded.load_state_dict(old_state_dict)
+
+        # scripted fusion attentions are upgraded by the neck
+        scripted = Attention(
+            in_channels=in_channels,
+            out_channels=out_channels,
+            num_outs=5,
+            attention_type='augmented',
+            map_repeated=map_repeated,
+            script_attention=True).eval()
+        scripted.init_weights()
+        scripted.load_state_dict(old_state_dict)
+
+        with torch.no_grad():
+            outs = attention_model(feats)
+            upgraded_outs = upgraded(feats)
+            scripted_outs = scripted(feats)
+        assert len(upgraded_outs) == len(scripted_outs) == len(outs)
+        for out, upgraded_out, scripted_out in zip(outs, upgraded_outs,
+                                                   scripted_outs):
+            assert torch.allclose(out, upgraded_out)
+            assert torch.allclose(out, scripted_out, atol=1e-5)